@@ -0,0 +1,103 @@
+"""Checks and rough timings for CategoryOptionIndex in openai-lambda-secure.py.
+
+    python benchmark_option_index.py
+
+Needs the Lambda's own dependencies (boto3, openai) installed; no AWS or
+OpenAI calls are made. The snapping cases run first and must all pass.
+"""
+
+import random
+import string
+import time
+
+from check_support import openai_lambda
+
+CategoryOptionIndex = openai_lambda.CategoryOptionIndex
+
+
+OPTIONS = ';'.join([
+    'Red', 'Blue', 'Navy Blue', 'Hand-Painted', 'Multicolor', 'Green',
+    '1959', '1990', '2000', 'US 7.5', 'US 9', '1/2', '日本',
+    'XL', 'L', 'No', 'New',
+])
+
+# (model value, expected canonical option or None when it must be flagged)
+CASES = [
+    ('red', 'Red'),
+    ('hand painted', 'Hand-Painted'),
+    ('Blu', 'Blue'),
+    ('Blue with white trim', 'Blue'),
+    ('Multicolour', 'Multicolor'),
+    ('Gren', 'Green'),
+    ('ＵＳ　７.５', 'US 7.5'),
+    ('日本', '日本'),
+    ('1/2', '1/2'),
+    ('Purple', None),
+    # numbers must match exactly, never by prefix or edit distance
+    ('1890', None),
+    ('1949', None),
+    ('2030', None),
+    ('US 6.5', None),
+    ('US 9.5', None),
+    ('1-2', None),
+    # too short for edit distance to tell a typo from a different option
+    ('XS', None),
+    ('XXL', None),
+    ('Not', None),
+    ('News', None),
+]
+
+
+def check_cases():
+    index = CategoryOptionIndex(OPTIONS)
+    for value, expected in CASES:
+        canonical, match_type = index.match(value)
+        assert canonical == expected, '%r: expected %r, got %r (%s)' % (value, expected, canonical, match_type)
+    print('%d snapping cases ok' % len(CASES))
+
+
+def make_options(size, rng):
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))) for _ in range(3 * size)]
+    options = set()
+    while len(options) < size:
+        options.add(' '.join(rng.sample(words, rng.randint(1, 3))).title())
+    return sorted(options)
+
+
+def make_query(option, kind, rng):
+    chars = list(option.lower())
+    if kind == 'one edit':
+        chars[rng.randrange(len(chars))] = 'z'
+    elif kind == 'two edits':
+        for position in rng.sample(range(len(chars)), 2):
+            chars[position] = 'q'
+    elif kind == 'miss':
+        chars = list('totally unrelated value')
+    return ''.join(chars)
+
+
+def main():
+    check_cases()
+    rng = random.Random(1)
+    for size in (1000, 5000, 20000):
+        options = make_options(size, rng)
+        start = time.perf_counter()
+        index = CategoryOptionIndex(';'.join(options))
+        build_time = time.perf_counter() - start
+
+        timings = {}
+        for option in rng.sample(options, 1000):
+            kind = rng.choice(['exact', 'one edit', 'two edits', 'miss'])
+            if kind == 'two edits' and len(option) < 8:
+                continue
+            query = make_query(option, kind, rng)
+            start = time.perf_counter()
+            index.match(query)
+            timings.setdefault(kind, []).append(time.perf_counter() - start)
+
+        print('%6d options  build %6.3fs  ' % (size, build_time) + '  '.join(
+            '%s %7.1fus' % (kind, 1e6 * sum(times) / len(times)) for kind, times in sorted(timings.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Checks the fast/strong model routing in openai-lambda-secure.py with a local fake client.
+
+    python check_model_routing.py
+
+Needs the Lambda's own dependencies (boto3, openai) installed; no AWS or
+OpenAI calls are made.
+"""
+
+import json
+
+from check_support import FakeClient, openai_lambda
+
+FIELDS = ['Color', 'Material', 'Era']
+CATEGORY_ITEM = {'Model': 'fast-model', 'EscalationModel': 'strong-model'}
+
+
+def reply(resolved):
+    return json.dumps({'title': 'Title', 'description': 'Description', 'aiResolvedFields': resolved})
+
+
+def run(replies, token_bucket=None):
+    client = FakeClient(lambda request: replies[request['model']])
+    routing_config = openai_lambda.build_routing_config(CATEGORY_ITEM, True, FIELDS)
+    result = openai_lambda.process_image_group_with_retry(
+        client, ['data:image/jpeg;base64,'], 'Describe the item', {}, True,
+        routing_config=routing_config, token_bucket=token_bucket)
+    return client.models, result
+
+
+def main():
+    two_of_three = reply({'Color': 'Red', 'Material': 'Wood'})
+    none_resolved = reply({})
+    all_resolved = reply({'Color': 'Red', 'Material': 'Wood', 'Era': '1950s'})
+
+    models, _ = run({'fast-model': two_of_three})
+    assert models == ['fast-model'], models
+    print('2/3 fields resolved: fast route only')
+
+    models, result = run({'fast-model': none_resolved, 'strong-model': all_resolved})
+    assert models == ['fast-model', 'strong-model'], models
+    assert len(result['aiResolvedFields']) == 3, result
+    print('0/3 fields resolved: escalated, strong result kept')
+
+    models, _ = run({'fast-model': 'not json at all', 'strong-model': all_resolved})
+    assert models == ['fast-model', 'strong-model'], models
+    print('unparseable fast response: escalated')
+
+    _, result = run({'fast-model': reply({'Color': 'Red'}), 'strong-model': none_resolved})
+    assert result['aiResolvedFields'] == {'Color': 'Red'}, result
+    print('strong route resolved fewer fields: fast result kept')
+
+    token_bucket = openai_lambda.TokenBucket()
+    run({'fast-model': none_resolved, 'strong-model': all_resolved}, token_bucket)
+    assert token_bucket.tokens_used > 0, 'strong route was not charged to the token bucket'
+    print('strong route charged %d estimated tokens' % token_bucket.tokens_used)
+
+
+if __name__ == '__main__':
+    main()
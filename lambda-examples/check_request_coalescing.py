@@ -0,0 +1,123 @@
+"""Checks in-flight request coalescing in openai-lambda-secure.py with a slow fake client.
+
+    python check_request_coalescing.py
+
+Needs the Lambda's own dependencies (boto3, openai) installed; no AWS or
+OpenAI calls are made.
+"""
+
+import json
+import threading
+
+from check_support import FakeClient, openai_lambda
+
+CATEGORY_ITEM = {'Model': 'fast-model', 'EscalationModel': ''}
+LATENCY = 0.2
+
+
+def slow_client():
+    """A fake client that answers every request after LATENCY seconds"""
+    content = json.dumps({'title': 'Title', 'description': 'Description'})
+    return FakeClient(lambda request: content, LATENCY)
+
+
+class CountingTokenBucket(openai_lambda.TokenBucket):
+    """TokenBucket that also keeps the net tokens charged, which refills never touch"""
+
+    def __init__(self):
+        super().__init__()
+        self.charged = 0
+        self.charged_lock = threading.Lock()
+
+    def consume(self, tokens):
+        with self.charged_lock:
+            self.charged += tokens
+        return super().consume(tokens)
+
+    def release(self, tokens):
+        with self.charged_lock:
+            self.charged -= tokens
+        super().release(tokens)
+
+
+def run(image_groups, max_concurrent_groups):
+    client = slow_client()
+    token_bucket = CountingTokenBucket()
+    deduplicated = openai_lambda.requestCoalescer.deduplicated
+    routing_config = openai_lambda.build_routing_config(CATEGORY_ITEM, False)
+    response = openai_lambda.process_individual_groups(
+        client, token_bucket, image_groups, 'Describe the item', {}, False,
+        routing_config=routing_config, max_concurrent_groups=max_concurrent_groups)
+    results = json.loads(response['body'])
+    assert len(results) == len(image_groups), results
+    assert all(result['title'] == 'Title' for result in results), results
+    return client.calls, openai_lambda.requestCoalescer.deduplicated - deduplicated, token_bucket
+
+
+def main():
+    same = ['data:image/jpeg;base64,AAAA']
+    other = ['data:image/jpeg;base64,BBBB']
+
+    calls, deduplicated, token_bucket = run([same] * 4, 4)
+    assert calls == 1, calls
+    assert deduplicated == 3, deduplicated
+    single_call_tokens = openai_lambda.estimate_tokens(same, 'Describe the item', {})
+    assert token_bucket.charged == single_call_tokens, (token_bucket.charged, single_call_tokens)
+    print('4 identical groups at once: 1 upstream call, 3 shared, only 1 call charged')
+
+    calls, deduplicated, _ = run([same, other, same, other], 4)
+    assert calls == 2, calls
+    assert deduplicated == 2, deduplicated
+    print('2 distinct groups twice each: 2 upstream calls')
+
+    calls, deduplicated, _ = run([same] * 4, 1)
+    assert calls == 4, calls
+    assert deduplicated == 0, deduplicated
+    print('4 identical groups one at a time: nothing coalesced')
+
+    openai_lambda.requestCoalescer.max_waiters = 1
+    try:
+        calls, deduplicated, _ = run([same] * 4, 4)
+    finally:
+        openai_lambda.requestCoalescer.max_waiters = openai_lambda.COALESCE_MAX_WAITERS
+    assert calls == 3, calls
+    assert deduplicated == 1, deduplicated
+    print('waiter cap of 1: extra identical groups call upstream themselves')
+
+    openai_lambda.requestCoalescer.timeout = LATENCY / 4
+    try:
+        calls, deduplicated, _ = run([same] * 4, 4)
+    finally:
+        openai_lambda.requestCoalescer.timeout = openai_lambda.COALESCE_TIMEOUT
+    assert calls == 4, calls
+    assert deduplicated == 0, deduplicated
+    print('waiters that time out call upstream and are not counted as deduplicated')
+
+    check_batches()
+
+
+def check_batches():
+    client = slow_client()
+    token_bucket = CountingTokenBucket()
+    routing_config = openai_lambda.build_routing_config(CATEGORY_ITEM, False)
+    batch = [['data:image/jpeg;base64,AAAA'], ['data:image/jpeg;base64,BBBB']]
+    estimated_tokens = openai_lambda.estimate_batch_tokens(batch, 'Describe the item', {}, False)
+
+    def process_batch():
+        token_bucket.consume(estimated_tokens)
+        openai_lambda.process_batch_with_retry_fixed(
+            client, batch, 'Describe the item', {}, False, routing_config=routing_config,
+            token_bucket=token_bucket, charged_tokens=estimated_tokens)
+
+    threads = [threading.Thread(target=process_batch) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.calls == 1, client.calls
+    assert token_bucket.charged == estimated_tokens, (token_bucket.charged, estimated_tokens)
+    print('2 identical batches at once: 1 upstream call, only 1 batch charged')
+
+
+if __name__ == '__main__':
+    main()
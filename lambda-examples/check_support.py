@@ -0,0 +1,51 @@
+"""Shared setup for the check and benchmark scripts in this directory.
+
+Loads openai-lambda-secure.py as a module; the file name is not importable
+directly. Needs the Lambda's own dependencies (boto3, openai) installed; no
+AWS or OpenAI calls are made.
+"""
+
+import importlib.util
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+_spec = importlib.util.spec_from_file_location(
+    'openai_lambda_secure', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openai-lambda-secure.py'))
+openai_lambda = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(openai_lambda)
+
+
+def make_completion(content):
+    """An object shaped like an OpenAI chat completion with the given reply and no cache hit"""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=500, completion_tokens=50, prompt_tokens_details=None))
+
+
+class FakeClient:
+    """Stands in for the OpenAI client: reply(request) gives each answer's content.
+
+    Every request's model is recorded in models. latency seconds are slept
+    before answering, so concurrent identical requests overlap.
+    """
+
+    def __init__(self, reply, latency=0):
+        self.reply = reply
+        self.latency = latency
+        self.models = []
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @property
+    def calls(self):
+        return len(self.models)
+
+    def create(self, **request):
+        with self.lock:
+            self.models.append(request['model'])
+        if self.latency:
+            time.sleep(self.latency)
+        return make_completion(self.reply(request))
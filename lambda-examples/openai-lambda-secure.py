@@ -1,12 +1,19 @@
 import base64
+import bisect
+import copy
+import hashlib
+import itertools
 import json
 import os
+import re
 import boto3
 import time
 import random
 import threading
+import unicodedata
 from openai import OpenAI
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # AWS clients
 secretsManager = boto3.client('secretsmanager')
@@ -16,6 +23,35 @@ dynamodb = boto3.resource('dynamodb')
 cachedCredentials = None
 cacheExpiry = 0
 
+# Prompt-prefix cache accounting (persists across warm invocations)
+cachedPrefixTokens = {}
+usageMetrics = {
+    'requests': 0,
+    'prompt_tokens': 0,
+    'cached_tokens': 0,
+    'completion_tokens': 0
+}
+
+# Model routing defaults; per-category overrides come from the ListCategory item
+DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'gpt-4o-mini-2024-07-18')
+DEFAULT_ESCALATION_MODEL = os.environ.get('ESCALATION_MODEL', 'gpt-4o-2024-08-06')
+DEFAULT_ESCALATION_THRESHOLD = float(os.environ.get('ESCALATION_THRESHOLD', '0.5'))
+ROUTING_ATTRIBUTES = ['Model', 'Temperature', 'MaxTokens', 'EscalationModel', 'EscalationThreshold']
+
+# Per-route latency and token statistics (persists across warm invocations)
+routeStats = {}
+
+# Guards usageMetrics and routeStats, which image group threads update together
+metricsLock = threading.Lock()
+
+# Single-flight settings for identical concurrent OpenAI requests
+COALESCE_MAX_WAITERS = int(os.environ.get('COALESCE_MAX_WAITERS', '8'))
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', '60'))
+
+# Option indexes keyed by (FieldLabel, CategoryOptions), reused across warm invocations
+categoryOptionIndexCache = {}
+MAX_OPTION_INDEX_CACHE_SIZE = 512
+
 def get_openai_api_key():
     """Get OpenAI API key from AWS Secrets Manager"""
     global cachedCredentials, cacheExpiry
@@ -80,6 +116,238 @@ class TokenBucket:
             
             self.tokens_used += tokens
             return True, 0
+    
+    def release(self, tokens):
+        """Give back tokens that were charged but served from the provider's prompt cache"""
+        with self.lock:
+            self.tokens_used = max(self.tokens_used - tokens, 0)
+
+class RequestCoalescer:
+    """Single-flight coalescing of identical in-flight requests within a container.
+    
+    The first caller for a key makes the upstream call; concurrent callers with
+    the same key wait on its future and get a deep copy of the result. Waiters
+    beyond max_waiters, or that time out, make their own call instead.
+    """
+    def __init__(self, max_waiters=8, timeout=60):
+        self.max_waiters = max_waiters
+        self.timeout = timeout
+        self.in_flight = {}
+        self.deduplicated = 0
+        self.lock = threading.Lock()
+    
+    def call(self, key, fn):
+        """Return (result, shared) where shared is True if another caller's call was reused"""
+        with self.lock:
+            flight = self.in_flight.get(key)
+            if flight is not None and flight['waiters'] < self.max_waiters:
+                flight['waiters'] += 1
+                future = flight['future']
+            else:
+                future = None
+                if flight is None:
+                    flight = {'future': Future(), 'waiters': 0}
+                    self.in_flight[key] = flight
+                else:
+                    flight = None  # Waiter cap reached, call upstream without sharing
+        
+        if future is not None:
+            try:
+                result = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                print(f"Coalesced request timed out after {self.timeout}s, calling upstream directly")
+                return fn(), False
+            # Only count waiters that were actually spared an upstream call
+            with self.lock:
+                self.deduplicated += 1
+            return copy.deepcopy(result), True
+        
+        if flight is None:
+            return fn(), False
+        
+        try:
+            result = fn()
+            flight['future'].set_result(result)
+            return result, False
+        except Exception as e:
+            flight['future'].set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                if self.in_flight.get(key) is flight:
+                    del self.in_flight[key]
+
+# Shared by every invocation this container serves
+requestCoalescer = RequestCoalescer(COALESCE_MAX_WAITERS, COALESCE_TIMEOUT)
+
+# Numbers plus the punctuation joining them: "9.5", "1,000", "1/2" and "1-2" are single tokens
+NUMBER_PATTERN = re.compile(r'\d+(?:[^\w\s]\d+)*')
+
+def normalize_option(value):
+    """Normalize an option for matching: NFKC, casefold and collapse whitespace.
+    
+    Punctuation is kept, since it can change meaning ("1/2" vs "1-2").
+    """
+    return ' '.join(unicodedata.normalize('NFKC', str(value)).casefold().split())
+
+def get_numeric_tokens(key):
+    """Numeric tokens in a normalized option ("us 9.5" -> ('9.5',), "1/2 in" -> ('1/2',))"""
+    return tuple(NUMBER_PATTERN.findall(key))
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein distance, or max_distance + 1 once it is known to exceed max_distance.
+    
+    Only the diagonal band of width 2 * max_distance + 1 is computed.
+    """
+    limit = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return limit
+    
+    previous = [j if j < limit else limit for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        char_a = a[i - 1]
+        low = i - max_distance if i > max_distance else 1
+        high = i + max_distance if i + max_distance < len(b) else len(b)
+        current = [limit] * (len(b) + 1)
+        current[0] = i if i < limit else limit
+        row_min = current[0]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if cost > limit:
+                cost = limit
+            current[j] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min >= limit:
+            return limit
+        previous = current
+    
+    return previous[-1]
+
+class CategoryOptionIndex:
+    """Precomputed lookup over one field's semicolon-separated CategoryOptions.
+    
+    Matching tries, in order: normalized exact lookup, unique prefix lookup and
+    bounded edit-distance lookup. Fuzzy candidates come from a bigram inverted
+    index (k edits destroy at most 2k of the value's bigrams), so only a handful
+    of options ever reach the edit-distance check. Prefix and fuzzy matches must
+    carry exactly the same numbers as the value, so "1890" never becomes "1990"
+    and "US 9.5" never becomes "US 9".
+    """
+    
+    def __init__(self, category_options, max_distance=2):
+        self.max_distance = max_distance
+        self.exact = {}
+        self.keys = []
+        self.numbers = {}
+        self.bigrams = {}
+        
+        for option in category_options.split(';'):
+            option = option.strip()
+            key = normalize_option(option)
+            if not key or key in self.exact:
+                continue
+            self.exact[key] = option
+            self.numbers[key] = get_numeric_tokens(key)
+            key_id = len(self.keys)
+            self.keys.append(key)
+            for bigram in self._bigrams(key):
+                self.bigrams.setdefault(bigram, []).append(key_id)
+        
+        self.sorted_keys = sorted(self.exact)
+    
+    def __len__(self):
+        return len(self.exact)
+    
+    @staticmethod
+    def _bigrams(key):
+        padded = f"^{key}$"
+        return {padded[i:i + 2] for i in range(len(padded) - 1)}
+    
+    def match(self, value):
+        """Return (canonical_option, match_type), or (None, None) if nothing is close enough"""
+        key = normalize_option(value)
+        if not key:
+            return None, None
+        
+        # 1. Normalized exact lookup
+        if key in self.exact:
+            return self.exact[key], 'exact'
+        
+        numbers = get_numeric_tokens(key)
+        
+        # 2. Prefix lookup: the value starts a single option ("Blu" -> "Blue") ...
+        start = bisect.bisect_left(self.sorted_keys, key)
+        if len(key) >= 3 and start < len(self.sorted_keys) and self.sorted_keys[start].startswith(key):
+            end = start + 1
+            if end >= len(self.sorted_keys) or not self.sorted_keys[end].startswith(key):
+                candidate = self.sorted_keys[start]
+                if self.numbers[candidate] == numbers:
+                    return self.exact[candidate], 'prefix'
+        
+        # ... or an option starts the value ("Blue with white trim" -> "Blue"), longest wins
+        words = key.split(' ')
+        for word_count in range(len(words) - 1, 0, -1):
+            candidate = ' '.join(words[:word_count])
+            if candidate in self.exact and self.numbers[candidate] == numbers:
+                return self.exact[candidate], 'prefix'
+        
+        # 3. Bounded edit-distance lookup: one edit per four characters, so
+        # values and options under four characters ("XS", "No") never fuzzy match
+        max_distance = min(self.max_distance, len(key) // 4)
+        if max_distance == 0:
+            return None, None
+        query_bigrams = self._bigrams(key)
+        min_shared = len(query_bigrams) - 2 * max_distance
+        
+        shared_counts = Counter(itertools.chain.from_iterable(
+            self.bigrams.get(bigram, ()) for bigram in query_bigrams
+        ))
+        
+        best_key, best_distance = None, max_distance + 1
+        for key_id, shared in shared_counts.items():
+            if shared < min_shared:
+                continue
+            candidate = self.keys[key_id]
+            if len(candidate) < 4 or self.numbers[candidate] != numbers:
+                continue
+            distance = bounded_edit_distance(key, candidate, best_distance - 1)
+            if distance < best_distance:
+                best_key, best_distance = candidate, distance
+                if distance == 1:
+                    break
+        
+        if best_key is not None:
+            return self.exact[best_key], 'fuzzy'
+        
+        return None, None
+
+def get_category_option_indexes(category_fields):
+    """Return {FieldLabel: CategoryOptionIndex} for fields with options, built once per container"""
+    indexes = {}
+    
+    for field in category_fields:
+        field_label = field.get('FieldLabel', '')
+        category_options = field.get('CategoryOptions', '')
+        if not field_label or not category_options or not category_options.strip():
+            continue
+        
+        cache_key = (field_label, category_options)
+        index = categoryOptionIndexCache.get(cache_key)
+        if index is None:
+            if len(categoryOptionIndexCache) >= MAX_OPTION_INDEX_CACHE_SIZE:
+                categoryOptionIndexCache.clear()
+            index = CategoryOptionIndex(category_options)
+            categoryOptionIndexCache[cache_key] = index
+        
+        if len(index) > 0:
+            indexes[field_label] = index
+    
+    return indexes
 
 def lambda_handler(event, context):
     """Main Lambda handler with secure API key management"""
@@ -95,6 +363,8 @@ def lambda_handler(event, context):
     # Batch configuration
     BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '1'))
     USE_BATCHING = os.environ.get('USE_BATCHING', 'false').lower() == 'true'
+    USE_PROMPT_CACHING = os.environ.get('USE_PROMPT_CACHING', 'true').lower() == 'true'
+    MAX_CONCURRENT_GROUPS = int(os.environ.get('MAX_CONCURRENT_GROUPS', '4'))
     
     if not category or not subCategory:
         return {
@@ -102,12 +372,13 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': 'Missing category or subcategory'})
         }
     
-    prompt = get_prompt_from_dynamodb(category, subCategory)
-    if 'error' in prompt:
+    category_item = get_category_item_from_dynamodb(category, subCategory)
+    if 'error' in category_item:
         return {
-            'statusCode': prompt.get('statusCode', 500),
-            'body': json.dumps(prompt)
+            'statusCode': category_item.get('statusCode', 500),
+            'body': json.dumps(category_item)
         }
+    prompt = category_item.get('Prompt', '')
     
     # Get API key from Secrets Manager
     try:
@@ -127,26 +398,48 @@ def lambda_handler(event, context):
     print(f"AI resolve fields: {ai_resolve_fields}")
     print(f"Category fields count: {len(category_fields)}")
     print(f"USE_BATCHING: {USE_BATCHING}, BATCH_SIZE: {BATCH_SIZE}")
+    print(f"USE_PROMPT_CACHING: {USE_PROMPT_CACHING}")
     
-    # Build enhanced prompt if AI field resolution is enabled
-    enhanced_prompt = prompt
+    # Precomputed CategoryOptions indexes for snapping aiResolvedFields values
+    option_indexes = {}
     if ai_resolve_fields and category_fields:
-        enhanced_prompt = build_enhanced_prompt_with_category_fields(prompt, category_fields, SelectedCategoryOptions)
-        print(f"Enhanced prompt built with {len(category_fields)} category fields")
+        option_indexes = get_category_option_indexes(category_fields)
+        print(f"Option indexes ready for {len(option_indexes)} category fields")
+    
+    resolvable_fields = []
+    if ai_resolve_fields and category_fields:
+        resolvable_fields = [field.get('FieldLabel', '') for field in get_empty_category_fields(category_fields, SelectedCategoryOptions)]
+    
+    routing_config = build_routing_config(category_item, ai_resolve_fields, resolvable_fields)
+    print(f"Routing: {routing_config['fast']['model']} -> {routing_config['strong']['model'] if routing_config['strong'] else 'no escalation'}")
+    
+    fields_to_resolve = None
+    if USE_PROMPT_CACHING:
+        # Stable system prefix: identical for every request in this subcategory,
+        # so the provider's automatic prefix caching can reuse it
+        enhanced_prompt = prompt
+        if ai_resolve_fields and category_fields:
+            enhanced_prompt = build_system_prefix_with_category_fields(prompt, category_fields)
+            fields_to_resolve = resolvable_fields
+            print(f"System prefix built with {len(category_fields)} category fields, {len(fields_to_resolve)} to resolve")
+    else:
+        # Build enhanced prompt if AI field resolution is enabled
+        enhanced_prompt = prompt
+        if ai_resolve_fields and category_fields:
+            enhanced_prompt = build_enhanced_prompt_with_category_fields(prompt, category_fields, SelectedCategoryOptions)
+            print(f"Enhanced prompt built with {len(category_fields)} category fields")
     
     # Intelligent batching - but disabled by default for now
     if USE_BATCHING and len(base64_image_groups) > 1 and len(base64_image_groups) <= BATCH_SIZE:
         print("Using batch processing")
-        return process_batched_groups(client, token_bucket, base64_image_groups, enhanced_prompt, SelectedCategoryOptions, BATCH_SIZE, ai_resolve_fields)
+        return process_batched_groups(client, token_bucket, base64_image_groups, enhanced_prompt, SelectedCategoryOptions, BATCH_SIZE, ai_resolve_fields, USE_PROMPT_CACHING, fields_to_resolve, option_indexes, routing_config)
     else:
         # Original single-group processing (this should work)
-        print("Using individual processing")
-        return process_individual_groups(client, token_bucket, base64_image_groups, enhanced_prompt, SelectedCategoryOptions, ai_resolve_fields)
+        print(f"Using individual processing, up to {MAX_CONCURRENT_GROUPS} groups at once")
+        return process_individual_groups(client, token_bucket, base64_image_groups, enhanced_prompt, SelectedCategoryOptions, ai_resolve_fields, USE_PROMPT_CACHING, fields_to_resolve, option_indexes, routing_config, MAX_CONCURRENT_GROUPS)
 
-def build_enhanced_prompt_with_category_fields(base_prompt, category_fields, field_selections):
-    """Build enhanced prompt that includes category fields resolution instructions"""
-    
-    # Filter out fields that already have user-provided values
+def get_empty_category_fields(category_fields, field_selections):
+    """Return the category fields that the user has not filled in"""
     empty_fields = []
     for field in category_fields:
         field_label = field.get('FieldLabel', '')
@@ -156,33 +449,31 @@ def build_enhanced_prompt_with_category_fields(base_prompt, category_fields, fie
         if not current_value or current_value == "-- Select --" or current_value.strip() == "":
             empty_fields.append(field)
     
-    if not empty_fields:
-        print("No empty category fields to resolve")
-        return base_prompt
-    
-    # Build the enhanced prompt
-    enhanced_prompt = base_prompt + "\n\n"
-    enhanced_prompt += "ADDITIONAL TASK: Based on the images and any existing information, please attempt to determine appropriate values for the following category fields that the user has not filled in:\n\n"
+    return empty_fields
+
+def build_category_fields_instructions(fields):
+    """Build the per-field instructions and the aiResolvedFields response format"""
+    instructions = ""
     
-    for field in empty_fields:
+    for field in fields:
         field_label = field.get('FieldLabel', '')
         category_options = field.get('CategoryOptions', '')
         
-        enhanced_prompt += f"**{field_label}**:\n"
+        instructions += f"**{field_label}**:\n"
         
         if category_options and category_options.strip():
             options = [opt.strip() for opt in category_options.split(';') if opt.strip()]
             if len(options) > 0 and len(options) <= 20:
-                enhanced_prompt += f"- Choose from: {', '.join(options)}\n"
+                instructions += f"- Choose from: {', '.join(options)}\n"
             elif len(options) > 20:
-                enhanced_prompt += f"- Choose from available options (there are {len(options)} total options)\n"
-                enhanced_prompt += f"- Some examples: {', '.join(options[:10])}\n"
+                instructions += f"- Choose from available options (there are {len(options)} total options)\n"
+                instructions += f"- Some examples: {', '.join(options[:10])}\n"
         else:
-            enhanced_prompt += f"- Provide an appropriate value\n"
+            instructions += f"- Provide an appropriate value\n"
         
-        enhanced_prompt += f"- If you cannot determine a value from the images, use 'Unknown' or 'Not Specified'\n\n"
+        instructions += f"- If you cannot determine a value from the images, use 'Unknown' or 'Not Specified'\n\n"
     
-    enhanced_prompt += """IMPORTANT: Please include these determined values in your JSON response under a new field called 'aiResolvedFields'. 
+    instructions += """IMPORTANT: Please include these determined values in your JSON response under a new field called 'aiResolvedFields'. 
 The structure should be:
 {
     "title": "your title here",
@@ -195,24 +486,202 @@ The structure should be:
 
 Only include fields in aiResolvedFields that you can reasonably determine from the images. If you cannot determine a value with confidence, omit that field entirely from aiResolvedFields.\n\n"""
     
+    return instructions
+
+def build_enhanced_prompt_with_category_fields(base_prompt, category_fields, field_selections):
+    """Build enhanced prompt that includes category fields resolution instructions"""
+    
+    # Filter out fields that already have user-provided values
+    empty_fields = get_empty_category_fields(category_fields, field_selections)
+    
+    if not empty_fields:
+        print("No empty category fields to resolve")
+        return base_prompt
+    
+    # Build the enhanced prompt
+    enhanced_prompt = base_prompt + "\n\n"
+    enhanced_prompt += "ADDITIONAL TASK: Based on the images and any existing information, please attempt to determine appropriate values for the following category fields that the user has not filled in:\n\n"
+    enhanced_prompt += build_category_fields_instructions(empty_fields)
+    
     print(f"Enhanced prompt with {len(empty_fields)} fields to resolve")
     return enhanced_prompt
 
-def process_individual_groups(client, token_bucket, image_groups, prompt, selected_options, ai_resolve_fields):
-    """Enhanced individual processing with AI field resolution support"""
-    all_results = []
+def build_system_prefix_with_category_fields(base_prompt, category_fields):
+    """Build the cacheable system prefix covering every category field.
+    
+    Nothing request-specific may go in here: the prefix must stay byte-identical
+    across requests for the same subcategory. Which fields still need resolving
+    is sent in the user message instead (see build_request_context_text).
+    """
+    system_prefix = base_prompt + "\n\n"
+    system_prefix += "ADDITIONAL TASK: Based on the images and any existing information, please attempt to determine appropriate values for the category fields listed in the request that the user has not filled in. The available category fields are:\n\n"
+    system_prefix += build_category_fields_instructions(category_fields)
+    return system_prefix
+
+def build_request_context_text(selected_options, fields_to_resolve):
+    """Build the per-request text that follows the cached system prefix"""
+    parts = []
+    
+    if selected_options:
+        options_str = json.dumps(selected_options, indent=2)
+        parts.append(f"Gain additional context on the images based on the following user selected options which describe the images:\n{options_str}")
+    
+    if fields_to_resolve is not None:
+        if fields_to_resolve:
+            parts.append(f"Category fields to resolve in aiResolvedFields: {', '.join(fields_to_resolve)}")
+        else:
+            parts.append("All category fields are already filled in by the user; return an empty aiResolvedFields object.")
+    
+    return "\n\n".join(parts)
+
+def build_image_content(image_group):
+    """Build the image_url content parts for one image group"""
+    return [{
+        "type": "image_url",
+        "image_url": {
+            "url": image_base64,
+            "detail": "low"
+        }
+    } for image_base64 in image_group]
+
+def create_chat_completion(client, **request):
+    """Call client.chat.completions.create, sharing one upstream call between identical concurrent requests.
+    
+    Returns (completion, shared); shared completions were already recorded by the caller that made them.
+    """
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+    return requestCoalescer.call(digest, lambda: client.chat.completions.create(**request))
+
+def get_prefix_key(model, prompt):
+    """Stable (model, prefix) key used to track cached-token counts; each model has its own prompt cache"""
+    return (model, hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+
+def record_usage(completion, prompt, route=None, latency_ms=0):
+    """Record token usage, including prompt-cache hits, and log it as metrics"""
+    usage = getattr(completion, 'usage', None)
+    if usage is None:
+        if route is not None:
+            record_route_stats(route, latency_ms, 0, 0)
+        return 0
+    
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+    
+    # Remember the latest cache hit for this model and prefix so the next estimate can subtract it
+    model = route['model'] if route is not None else getattr(completion, 'model', DEFAULT_MODEL)
+    cachedPrefixTokens[get_prefix_key(model, prompt)] = cached_tokens
+    
+    with metricsLock:
+        usageMetrics['requests'] += 1
+        usageMetrics['prompt_tokens'] += prompt_tokens
+        usageMetrics['cached_tokens'] += cached_tokens
+        usageMetrics['completion_tokens'] += completion_tokens
+        totals = dict(usageMetrics)
+    
+    if route is not None:
+        record_route_stats(route, latency_ms, prompt_tokens, completion_tokens)
+    
+    print("Usage metrics: " + json.dumps({
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'completion_tokens': completion_tokens,
+        'totals': totals
+    }))
+    return cached_tokens
+
+def build_routing_config(category_item, ai_resolve_fields, expected_fields=None):
+    """Build the fast/strong model routes from the ListCategory item.
+    
+    Optional item attributes: Model, Temperature, MaxTokens, EscalationModel
+    and EscalationThreshold (fraction of expected aiResolvedFields left
+    unresolved that triggers escalation). Set EscalationModel to an empty
+    string to never escalate for a category.
+    """
+    fast_route = {
+        'name': 'fast',
+        'model': str(category_item.get('Model') or DEFAULT_MODEL),
+        'temperature': float(category_item.get('Temperature', 0.7)),
+        'max_tokens': int(category_item.get('MaxTokens', 1000 if ai_resolve_fields else 800))  # More tokens if AI fields resolution
+    }
+    
+    strong_route = None
+    escalation_model = category_item.get('EscalationModel', DEFAULT_ESCALATION_MODEL)
+    if escalation_model and escalation_model != fast_route['model']:
+        strong_route = dict(fast_route, name='strong', model=str(escalation_model))
+    
+    return {
+        'fast': fast_route,
+        'strong': strong_route,
+        'escalation_threshold': float(category_item.get('EscalationThreshold', DEFAULT_ESCALATION_THRESHOLD)),
+        'expected_fields': list(expected_fields or [])
+    }
+
+def get_escalation_reason(result, routing_config):
+    """Return why a fast-route result should be retried on the strong route, or None"""
+    if not isinstance(result, dict):
+        return "response is not an object"
+    
+    if 'error' in result:
+        # Only escalate on bad model output; API failures would fail again
+        return "unparseable response" if 'raw_content' in result else None
+    
+    if not result.get('title') or not result.get('description'):
+        return "missing title or description"
+    
+    expected_fields = routing_config['expected_fields']
+    if expected_fields:
+        resolved_fields = result.get('aiResolvedFields') or {}
+        unresolved = sum(1 for label in expected_fields if label not in resolved_fields)
+        if unresolved / len(expected_fields) > routing_config['escalation_threshold']:
+            return f"{unresolved}/{len(expected_fields)} category fields unresolved"
+    
+    return None
+
+def get_route_key(route):
+    """Stats key for a route, e.g. 'fast/gpt-4o-mini-2024-07-18'"""
+    return f"{route['name']}/{route['model']}"
+
+def record_route_stats(route, latency_ms, prompt_tokens, completion_tokens):
+    """Accumulate per-route latency and token statistics"""
+    with metricsLock:
+        stats = routeStats.setdefault(get_route_key(route), {
+            'calls': 0,
+            'escalations': 0,
+            'total_latency_ms': 0,
+            'max_latency_ms': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0
+        })
+        stats['calls'] += 1
+        stats['total_latency_ms'] += latency_ms
+        stats['max_latency_ms'] = max(stats['max_latency_ms'], latency_ms)
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+
+def process_individual_groups(client, token_bucket, image_groups, prompt, selected_options, ai_resolve_fields, use_prompt_caching=False, fields_to_resolve=None, option_indexes=None, routing_config=None, max_concurrent_groups=1):
+    """Enhanced individual processing with AI field resolution support.
     
-    for i, image_group in enumerate(image_groups):
+    Up to max_concurrent_groups image groups run at once, so identical groups
+    in flight together share one OpenAI call through requestCoalescer.
+    """
+    if routing_config is None:
+        routing_config = build_routing_config({}, ai_resolve_fields, fields_to_resolve)
+    prefix_key = get_prefix_key(routing_config['fast']['model'], prompt)
+    
+    def process_group(i, image_group):
         print(f"Processing image group {i+1}/{len(image_groups)}")
         
-        estimated_tokens = estimate_tokens(image_group, prompt, selected_options)
+        expected_cached_tokens = cachedPrefixTokens.get(prefix_key, 0)
+        estimated_tokens = estimate_tokens(image_group, prompt, selected_options, expected_cached_tokens)
         can_proceed, wait_time = token_bucket.consume(estimated_tokens)
         
         if not can_proceed:
             print(f"Rate limit hit, waiting {wait_time} seconds")
             time.sleep(wait_time + 0.1)
         
-        result = process_image_group_with_retry(client, image_group, prompt, selected_options, ai_resolve_fields)
+        result = process_image_group_with_retry(client, image_group, prompt, selected_options, ai_resolve_fields, use_prompt_caching=use_prompt_caching, fields_to_resolve=fields_to_resolve, option_indexes=option_indexes, routing_config=routing_config, token_bucket=token_bucket, charged_tokens=estimated_tokens, expected_cached_tokens=expected_cached_tokens)
         
         # Enhanced result logging
         if isinstance(result, dict):
@@ -222,16 +691,38 @@ def process_individual_groups(client, token_bucket, image_groups, prompt, select
         else:
             print(f"Result for group {i+1}: {str(result)[:50]}")
         
-        all_results.append(result)
+        return result
+    
+    # map keeps results in image group order
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent_groups, len(image_groups)))) as executor:
+        all_results = list(executor.map(process_group, range(len(image_groups)), image_groups))
     
     print(f"Completed processing {len(all_results)} groups")
+    with metricsLock:
+        print(f"Route stats: {json.dumps(routeStats)}")
+    print(f"Deduplicated in-flight calls: {requestCoalescer.deduplicated}")
     return {
         'statusCode': 200,
         'body': json.dumps(all_results)
     }
 
-def process_image_group_with_retry(client, image_group, prompt, selected_options, ai_resolve_fields, max_retries=3):
-    """Process a single image group with enhanced error handling and AI field resolution"""
+def build_chat_messages(prompt, image_group, selected_options, use_prompt_caching=False, fields_to_resolve=None):
+    """Build the chat messages for a single image group.
+    
+    With prompt caching the stable prompt goes first as a system message and
+    everything request-specific follows it in the user message. Otherwise the
+    original single user message layout is used.
+    """
+    if use_prompt_caching:
+        content = []
+        context_text = build_request_context_text(selected_options, fields_to_resolve)
+        if context_text:
+            content.append({"type": "text", "text": context_text})
+        content.extend(build_image_content(image_group))
+        return [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": content}
+        ]
     
     # Build the prompt with selected options (matching your original logic)
     if selected_options:
@@ -245,29 +736,97 @@ def process_image_group_with_retry(client, image_group, prompt, selected_options
     content = [{"type": "text", "text": enhanced_prompt}]
     
     # Add each image from the group
-    for image_base64 in image_group:
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": image_base64,
-                "detail": "low"
-            }
-        })
+    content.extend(build_image_content(image_group))
+    
+    return [{
+        "role": "user",
+        "content": content
+    }]
+
+def process_image_group_with_retry(client, image_group, prompt, selected_options, ai_resolve_fields, max_retries=3, use_prompt_caching=False, fields_to_resolve=None, option_indexes=None, routing_config=None, token_bucket=None, charged_tokens=0, expected_cached_tokens=0):
+    """Process a single image group with enhanced error handling and AI field resolution.
+    
+    The fast route always goes first; the strong route is only paid for when
+    the fast result fails validation or leaves too many fields unresolved.
+    The caller charges token_bucket for the fast call (charged_tokens,
+    estimated with expected_cached_tokens); the strong call is charged here.
+    Each call's cache hits beyond its estimate are credited back.
+    """
+    if routing_config is None:
+        routing_config = build_routing_config({}, ai_resolve_fields, fields_to_resolve)
+    
+    messages = build_chat_messages(prompt, image_group, selected_options, use_prompt_caching, fields_to_resolve)
+    
+    result, cached_tokens = request_completion_with_retry(client, messages, prompt, ai_resolve_fields, routing_config['fast'], max_retries, option_indexes, token_bucket, charged_tokens)
+    if token_bucket is not None and cached_tokens > expected_cached_tokens:
+        token_bucket.release(cached_tokens - expected_cached_tokens)
+    
+    strong_route = routing_config['strong']
+    escalation_reason = get_escalation_reason(result, routing_config) if strong_route else None
+    if not escalation_reason:
+        return result
+    
+    print(f"Escalating to {strong_route['model']}: {escalation_reason}")
+    fast_route_key = get_route_key(routing_config['fast'])
+    with metricsLock:
+        if fast_route_key in routeStats:
+            routeStats[fast_route_key]['escalations'] += 1
+    
+    strong_estimated_tokens = 0
+    strong_expected_cached_tokens = cachedPrefixTokens.get(get_prefix_key(strong_route['model'], prompt), 0)
+    if token_bucket is not None:
+        strong_estimated_tokens = estimate_tokens(image_group, prompt, selected_options, strong_expected_cached_tokens)
+        can_proceed, wait_time = token_bucket.consume(strong_estimated_tokens)
+        if not can_proceed:
+            print(f"Rate limit hit, waiting {wait_time} seconds")
+            time.sleep(wait_time + 0.1)
+    
+    strong_result, cached_tokens = request_completion_with_retry(client, messages, prompt, ai_resolve_fields, strong_route, max_retries, option_indexes, token_bucket, strong_estimated_tokens)
+    if token_bucket is not None and cached_tokens > strong_expected_cached_tokens:
+        token_bucket.release(cached_tokens - strong_expected_cached_tokens)
+    
+    # Keep the fast result if the strong route did no better
+    if score_result(strong_result) < score_result(result):
+        print("Strong route did no better, keeping fast route result")
+        return result
+    return strong_result
+
+def score_result(result):
+    """Rank results: valid beats error, complete beats missing title/description, then resolved field count"""
+    if not isinstance(result, dict) or 'error' in result:
+        return (0, 0, 0)
+    has_content = 1 if result.get('title') and result.get('description') else 0
+    return (1, has_content, len(result.get('aiResolvedFields') or {}))
+
+def request_completion_with_retry(client, messages, prompt, ai_resolve_fields, route, max_retries=3, option_indexes=None, token_bucket=None, charged_tokens=0):
+    """Call one model route with retries and parse its response.
     
+    Returns (result, cached_tokens), the prompt-cache hit of this call. If the
+    completion is shared with an identical in-flight request, the whole
+    charged_tokens estimate is given back to token_bucket and cached_tokens
+    is 0, so callers have nothing more to credit.
+    """
+    cached_tokens = 0
     retries = 0
     while retries <= max_retries:
         try:
-            print(f"Making OpenAI API call (attempt {retries + 1}/{max_retries + 1})")
+            print(f"Making OpenAI API call on {route['name']} route (attempt {retries + 1}/{max_retries + 1})")
             
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini-2024-07-18",
-                messages=[{
-                    "role": "user",
-                    "content": content
-                }],
-                max_tokens=1000 if ai_resolve_fields else 800,  # More tokens if AI fields resolution
-                temperature=0.7
+            start_time = time.time()
+            completion, shared = create_chat_completion(
+                client,
+                model=route['model'],
+                messages=messages,
+                max_tokens=route['max_tokens'],
+                temperature=route['temperature']
             )
+            if shared:
+                print(f"Reused in-flight {route['name']} route response for identical request")
+                if token_bucket is not None and charged_tokens:
+                    token_bucket.release(charged_tokens)
+                cached_tokens = 0
+            else:
+                cached_tokens = record_usage(completion, prompt, route, int((time.time() - start_time) * 1000))
             
             response_content = completion.choices[0].message.content
             print(f"Received response: {response_content[:100]}...")
@@ -303,18 +862,18 @@ def process_image_group_with_retry(client, image_group, prompt, selected_options
                 print("Successfully parsed JSON response")
                 
                 # Post-process the response to ensure proper format
-                processed_response = post_process_response(parsed_response, ai_resolve_fields)
+                processed_response = post_process_response(parsed_response, ai_resolve_fields, option_indexes)
                 
                 # Validate the response has the expected structure
                 if isinstance(processed_response, dict):
                     if 'title' in processed_response or 'description' in processed_response:
-                        return processed_response
+                        return processed_response, cached_tokens
                     else:
                         print("Warning: Response missing expected fields, but continuing...")
-                        return processed_response
+                        return processed_response, cached_tokens
                 else:
                     print(f"Warning: Expected dict, got {type(processed_response)}")
-                    return processed_response
+                    return processed_response, cached_tokens
                 
             except json.JSONDecodeError as e:
                 print(f"JSON parse error: {e}")
@@ -324,12 +883,12 @@ def process_image_group_with_retry(client, image_group, prompt, selected_options
                 fallback_result = extract_info_from_text(response_content, ai_resolve_fields)
                 if fallback_result:
                     print("Using fallback text extraction")
-                    return post_process_response(fallback_result, ai_resolve_fields)
+                    return post_process_response(fallback_result, ai_resolve_fields, option_indexes), cached_tokens
                 else:
                     return {
                         "error": "Could not parse response as JSON",
                         "raw_content": response_content
-                    }
+                    }, cached_tokens
                 
         except Exception as e:
             retries += 1
@@ -354,9 +913,9 @@ def process_image_group_with_retry(client, image_group, prompt, selected_options
     return {
         "error": f"Failed to process after {max_retries + 1} attempts",
         "last_error": error_msg if 'error_msg' in locals() else "Unknown error"
-    }
+    }, cached_tokens
 
-def post_process_response(response, ai_resolve_fields):
+def post_process_response(response, ai_resolve_fields, option_indexes=None):
     """Post-process the OpenAI response to ensure proper format and handle AI resolved fields"""
     if not isinstance(response, dict):
         return response
@@ -414,6 +973,12 @@ def post_process_response(response, ai_resolve_fields):
                 if field_value and str(field_value).strip() and field_value != "Unknown" and field_value != "Not Specified":
                     cleaned_ai_fields[field_name] = str(field_value).strip()
             
+            if option_indexes:
+                cleaned_ai_fields, unmatched_fields = snap_ai_resolved_fields(cleaned_ai_fields, option_indexes)
+                if unmatched_fields:
+                    processed['aiUnmatchedFields'] = unmatched_fields
+                    print(f"AI resolved fields not in CategoryOptions: {list(unmatched_fields.keys())}")
+            
             processed['aiResolvedFields'] = cleaned_ai_fields
             print(f"Processed AI resolved fields: {list(cleaned_ai_fields.keys())}")
         else:
@@ -423,13 +988,39 @@ def post_process_response(response, ai_resolve_fields):
     
     # Handle any other fields that might be objects but should be strings
     for key, value in processed.items():
-        if isinstance(value, dict) and key not in ['storedFieldSelections', 'aiResolvedFields']:
+        if isinstance(value, dict) and key not in ['storedFieldSelections', 'aiResolvedFields', 'aiUnmatchedFields']:
             # Convert other unexpected objects to strings
             processed[key] = json.dumps(value)
             print(f"Converted {key} object to JSON string")
     
     return processed
 
+def snap_ai_resolved_fields(ai_fields, option_indexes):
+    """Snap AI resolved values to canonical CategoryOptions.
+    
+    Returns (snapped_fields, unmatched_fields). Fields without an option list
+    are free text and pass through unchanged.
+    """
+    snapped = {}
+    unmatched = {}
+    
+    for field_name, field_value in ai_fields.items():
+        index = option_indexes.get(field_name)
+        if index is None:
+            snapped[field_name] = field_value
+            continue
+        
+        canonical, match_type = index.match(field_value)
+        if canonical is None:
+            unmatched[field_name] = field_value
+            continue
+        
+        if match_type != 'exact' or canonical != field_value:
+            print(f"Snapped {field_name}: '{field_value}' -> '{canonical}' ({match_type})")
+        snapped[field_name] = canonical
+    
+    return snapped, unmatched
+
 def extract_info_from_text(text, ai_resolve_fields):
     """Enhanced fallback function to extract title, description, and AI resolved fields from text"""
     try:
@@ -530,13 +1121,13 @@ def extract_info_from_text(text, ai_resolve_fields):
         print(f"Text extraction error: {e}")
         return None
 
-def estimate_tokens(image_group, prompt, selected_options):
+def estimate_tokens(image_group, prompt, selected_options, cached_tokens=0):
     """
     Roughly estimate token usage for a request.
     This is a very rough estimate - a better implementation would use tiktoken
     """
-    # Base tokens for prompt and system message
-    prompt_tokens = len(prompt.split()) * 1.3  # Rough conversion from words to tokens
+    # Base tokens for prompt and system message, minus the part served from the prompt cache
+    prompt_tokens = max(len(prompt.split()) * 1.3 - cached_tokens, 0)  # Rough conversion from words to tokens
     
     # Tokens for options
     options_tokens = 0
@@ -557,9 +1148,12 @@ def estimate_tokens(image_group, prompt, selected_options):
     return int(total_estimated * 1.2)
 
 # Keep the batching functions but update them for AI field resolution
-def process_batched_groups(client, token_bucket, image_groups, prompt, selected_options, batch_size, ai_resolve_fields):
+def process_batched_groups(client, token_bucket, image_groups, prompt, selected_options, batch_size, ai_resolve_fields, use_prompt_caching=False, fields_to_resolve=None, option_indexes=None, routing_config=None):
     """Process multiple image groups in a single OpenAI request with AI field resolution support"""
     all_results = []
+    if routing_config is None:
+        routing_config = build_routing_config({}, ai_resolve_fields, fields_to_resolve)
+    prefix_key = get_prefix_key(routing_config['fast']['model'], prompt)
     
     # Group image groups into batches
     for i in range(0, len(image_groups), batch_size):
@@ -567,14 +1161,15 @@ def process_batched_groups(client, token_bucket, image_groups, prompt, selected_
         print(f"Processing batch {i//batch_size + 1} with {len(batch)} groups")
         
         # Estimate tokens for the entire batch
-        estimated_tokens = estimate_batch_tokens(batch, prompt, selected_options, ai_resolve_fields)
+        expected_cached_tokens = cachedPrefixTokens.get(prefix_key, 0)
+        estimated_tokens = estimate_batch_tokens(batch, prompt, selected_options, ai_resolve_fields, expected_cached_tokens)
         
         can_proceed, wait_time = token_bucket.consume(estimated_tokens)
         if not can_proceed:
             time.sleep(wait_time + 0.1)
         
         # Process batch
-        batch_results = process_batch_with_retry_fixed(client, batch, prompt, selected_options, ai_resolve_fields)
+        batch_results = process_batch_with_retry_fixed(client, batch, prompt, selected_options, ai_resolve_fields, use_prompt_caching=use_prompt_caching, fields_to_resolve=fields_to_resolve, option_indexes=option_indexes, routing_config=routing_config, token_bucket=token_bucket, charged_tokens=estimated_tokens, expected_cached_tokens=expected_cached_tokens)
         
         # Ensure we have the right number of results
         if len(batch_results) != len(batch):
@@ -586,13 +1181,21 @@ def process_batched_groups(client, token_bucket, image_groups, prompt, selected_
         all_results.extend(batch_results)
     
     print(f"Batch processing complete: {len(all_results)} total results")
+    print(f"Route stats: {json.dumps(routeStats)}")
+    print(f"Deduplicated in-flight calls: {requestCoalescer.deduplicated}")
     return {
         'statusCode': 200,
         'body': json.dumps(all_results)
     }
 
-def process_batch_with_retry_fixed(client, image_groups_batch, prompt, selected_options, ai_resolve_fields, max_retries=3):
-    """FIXED: Process a batch of image groups in a single OpenAI request with AI field resolution"""
+def process_batch_with_retry_fixed(client, image_groups_batch, prompt, selected_options, ai_resolve_fields, max_retries=3, use_prompt_caching=False, fields_to_resolve=None, option_indexes=None, routing_config=None, token_bucket=None, charged_tokens=0, expected_cached_tokens=0):
+    """FIXED: Process a batch of image groups in a single OpenAI request with AI field resolution.
+    
+    The caller charges token_bucket for the batch (charged_tokens, estimated
+    with expected_cached_tokens). As on the individual path, a shared
+    completion gives the whole charge back and a fresh one credits its cache
+    hits beyond the estimate.
+    """
     
     # Build enhanced prompt for batch processing
     if selected_options:
@@ -602,9 +1205,7 @@ def process_batch_with_retry_fixed(client, image_groups_batch, prompt, selected_
         ai_fields_part = '"aiResolvedFields": {}' if ai_resolve_fields else ''
         comma_part = ',' if ai_resolve_fields else ''
         
-        batch_prompt = f"""{prompt}
-
-IMPORTANT: You are processing {len(image_groups_batch)} separate product groups. 
+        batch_instructions = f"""IMPORTANT: You are processing {len(image_groups_batch)} separate product groups. 
 Each group represents a different product that needs its own listing.
 
 Please return a JSON array with exactly {len(image_groups_batch)} objects, one for each product group.
@@ -623,9 +1224,7 @@ Process each group of images as a separate product. Return ONLY the JSON array,
         ai_fields_part = '"aiResolvedFields": {}' if ai_resolve_fields else ''
         comma_part = ',' if ai_resolve_fields else ''
         
-        batch_prompt = f"""{prompt}
-
-IMPORTANT: You are processing {len(image_groups_batch)} separate product groups.
+        batch_instructions = f"""IMPORTANT: You are processing {len(image_groups_batch)} separate product groups.
 Please return a JSON array with exactly {len(image_groups_batch)} objects, one for each product group.
 Each object should follow this format:
 {{
@@ -636,8 +1235,15 @@ Each object should follow this format:
 
 Return ONLY the JSON array, no additional text."""
     
+    if use_prompt_caching and fields_to_resolve is not None:
+        batch_instructions += "\n\n" + build_request_context_text(None, fields_to_resolve)
+    
     # Build image content for all groups
-    content = [{"type": "text", "text": batch_prompt}]
+    if use_prompt_caching:
+        # Stable prompt stays in the cacheable system prefix
+        content = [{"type": "text", "text": batch_instructions}]
+    else:
+        content = [{"type": "text", "text": f"{prompt}\n\n{batch_instructions}"}]
     
     for group_idx, image_group in enumerate(image_groups_batch):
         # Add separator text for each group
@@ -647,29 +1253,41 @@ Return ONLY the JSON array, no additional text."""
         })
         
         # Add all images from this group
-        for image_base64 in image_group:
-            content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": image_base64,
-                    "detail": "low"
-                }
-            })
+        content.extend(build_image_content(image_group))
+    
+    messages = [{
+        "role": "user",
+        "content": content
+    }]
+    if use_prompt_caching:
+        messages.insert(0, {"role": "system", "content": prompt})
+    
+    # Batches always run on the fast route; escalation is per image group only
+    if routing_config is None:
+        routing_config = build_routing_config({}, ai_resolve_fields, fields_to_resolve)
+    route = routing_config['fast']
     
     retries = 0
     while retries <= max_retries:
         try:
             print(f"Making batch API call (attempt {retries + 1}/{max_retries + 1})")
             
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini-2024-07-18",
-                messages=[{
-                    "role": "user",
-                    "content": content
-                }],
-                max_tokens=(1000 if ai_resolve_fields else 800) * len(image_groups_batch),  # Scale tokens with batch size and AI fields
-                temperature=0.7
+            start_time = time.time()
+            completion, shared = create_chat_completion(
+                client,
+                model=route['model'],
+                messages=messages,
+                max_tokens=route['max_tokens'] * len(image_groups_batch),  # Scale tokens with batch size and AI fields
+                temperature=route['temperature']
             )
+            if shared:
+                print("Reused in-flight batch response for identical request")
+                if token_bucket is not None and charged_tokens:
+                    token_bucket.release(charged_tokens)
+            else:
+                cached_tokens = record_usage(completion, prompt, route, int((time.time() - start_time) * 1000))
+                if token_bucket is not None and cached_tokens > expected_cached_tokens:
+                    token_bucket.release(cached_tokens - expected_cached_tokens)
             
             response_content = completion.choices[0].message.content
             print(f"Batch response: {response_content[:200]}...")
@@ -691,7 +1309,7 @@ Return ONLY the JSON array, no additional text."""
                     if len(parsed_response) == len(image_groups_batch):
                         print(f"Successfully parsed batch with {len(parsed_response)} results")
                         # Post-process each result in the batch
-                        processed_results = [post_process_response(result, ai_resolve_fields) for result in parsed_response]
+                        processed_results = [post_process_response(result, ai_resolve_fields, option_indexes) for result in parsed_response]
                         return processed_results
                     else:
                         print(f"Warning: Expected {len(image_groups_batch)} results, got {len(parsed_response)}")
@@ -699,12 +1317,12 @@ Return ONLY the JSON array, no additional text."""
                         while len(parsed_response) < len(image_groups_batch):
                             parsed_response.append({"error": "Missing batch result"})
                         # Post-process each result
-                        processed_results = [post_process_response(result, ai_resolve_fields) for result in parsed_response[:len(image_groups_batch)]]
+                        processed_results = [post_process_response(result, ai_resolve_fields, option_indexes) for result in parsed_response[:len(image_groups_batch)]]
                         return processed_results
                 elif isinstance(parsed_response, dict):
                     # Single object returned, wrap in array and pad
                     print("Single object returned, expected array")
-                    result = [post_process_response(parsed_response, ai_resolve_fields)]
+                    result = [post_process_response(parsed_response, ai_resolve_fields, option_indexes)]
                     while len(result) < len(image_groups_batch):
                         result.append({"error": "Missing batch result"})
                     return result
@@ -739,10 +1357,10 @@ Return ONLY the JSON array, no additional text."""
     error_result = {"error": "Batch processing failed after max retries"}
     return [error_result] * len(image_groups_batch)
 
-def estimate_batch_tokens(image_groups_batch, prompt, selected_options, ai_resolve_fields):
+def estimate_batch_tokens(image_groups_batch, prompt, selected_options, ai_resolve_fields, cached_tokens=0):
     """Estimate tokens for a batch of image groups with AI field resolution"""
-    # Base tokens for prompt
-    prompt_tokens = len(prompt.split()) * 1.3
+    # Base tokens for prompt, minus the part served from the prompt cache
+    prompt_tokens = max(len(prompt.split()) * 1.3 - cached_tokens, 0)
     
     # Options tokens
     options_tokens = len(json.dumps(selected_options or {})) * 0.3
@@ -761,24 +1379,26 @@ def estimate_batch_tokens(image_groups_batch, prompt, selected_options, ai_resol
     total = prompt_tokens + options_tokens + image_tokens + output_tokens + batch_overhead
     return int(total * 1.2)  # Safety buffer
 
-def get_prompt_from_dynamodb(category, subCategory):
-    """Retrieve prompt from DynamoDB table based on category and subcategory."""
+def get_category_item_from_dynamodb(category, subCategory):
+    """Retrieve the prompt and model routing settings from DynamoDB based on category and subcategory."""
     try:
         # DynamoDB table is already initialized at module level
         table = dynamodb.Table('ListCategory')  # Your actual table name
         
+        attribute_names = {f"#{name}": name for name in ['Prompt'] + ROUTING_ATTRIBUTES}
         response = table.get_item(
             Key={
                 'Category': category,
                 'SubCategory': subCategory
             },
-            ProjectionExpression='Prompt'  # Return only the 'Prompt' field
+            ProjectionExpression=', '.join(attribute_names),  # Prompt and routing settings only
+            ExpressionAttributeNames=attribute_names
         )
         
         if 'Item' in response:
-            prompt = response['Item'].get('Prompt', '')
-            print(f"Retrieved prompt for {category}/{subCategory}: {prompt[:100]}...")
-            return prompt
+            item = response['Item']
+            print(f"Retrieved prompt for {category}/{subCategory}: {item.get('Prompt', '')[:100]}...")
+            return item
         else:
             print(f"No prompt found for {category}/{subCategory}")
             return {
@@ -799,6 +1419,14 @@ def get_prompt_from_dynamodb(category, subCategory):
 # OPENAI_API_KEY - Fallback if Secrets Manager fails (not recommended for production)
 # BATCH_SIZE - Batch processing size (default: 1)
 # USE_BATCHING - Enable batch processing (default: false)
+# DEFAULT_MODEL - Fast-route model when the category has no Model (default: gpt-4o-mini-2024-07-18)
+# ESCALATION_MODEL - Strong-route model when the category has no EscalationModel, empty disables (default: gpt-4o-2024-08-06)
+# ESCALATION_THRESHOLD - Unresolved category field fraction that triggers escalation (default: 0.5)
+# COALESCE_MAX_WAITERS - Max concurrent identical requests sharing one OpenAI call (default: 8)
+# COALESCE_TIMEOUT - Seconds a coalesced request waits before calling OpenAI itself (default: 60)
+# MAX_CONCURRENT_GROUPS - Image groups processed at once in individual mode; 1 disables coalescing (default: 4)
+# USE_PROMPT_CACHING - Send the category prompt as a stable system prefix so the
+#                      provider's automatic prompt caching can reuse it (default: true)
 
 # IAM Role permissions required:
 # {
@@ -578,6 +578,7 @@ Action(SiteID=US|Country=US|Currency=USD|Version=1193|CC=UTF-8),Custom label (SK
               key !== 'description' && 
               key !== 'storedFieldSelections' && 
               key !== 'aiResolvedFields' && 
+              key !== 'aiUnmatchedFields' && 
               !key.startsWith('error') && 
               !key.startsWith('raw_')
             )